@@ -1,28 +1,53 @@
+import atexit
 import os
 import time
 import logging
+import queue
+import random
+import signal
+import stat
+import tempfile
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, timedelta
 import asyncio
-import json
+import collections
+import functools
 import aiohttp
+import orjson
 import csv
-from rapidfuzz import process, fuzz
+import re
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None  # Keyword matching falls back to a compiled regex
+from typing import Optional
+from rapidfuzz import process, fuzz, utils
 from twitchAPI.twitch import Twitch
 # Updated imports for newer twitchAPI versions
-from twitchAPI.type import AuthScope, ChatEvent
+from twitchAPI.type import AuthScope, ChatEvent, UnauthorizedException
 from twitchAPI.chat import Chat, EventData, ChatMessage
 from twitchAPI.helper import first
 from dotenv import load_dotenv
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("goocrew_clipbot.log"),
-        logging.StreamHandler()
-    ]
-)
+# Records are queued on the event loop thread and written to the file and
+# console by a background listener thread, so disk writes never block chat
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.FileHandler("goocrew_clipbot.log"),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush queued records on every exit path
+
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
 logger = logging.getLogger('GooCrewClipBot')
 
 # Load environment variables
@@ -33,80 +58,149 @@ APP_SECRET = os.getenv('TWITCH_CLIENT_SECRET')  # We need this for the API initi
 ACCESS_TOKEN = os.getenv('TWITCH_ACCESS_TOKEN')
 REFRESH_TOKEN = os.getenv('TWITCH_REFRESH_TOKEN')
 
-USER_SCOPE = [
+USER_SCOPE = (
     AuthScope.CHAT_READ,
     AuthScope.CLIPS_EDIT,
     AuthScope.CHANNEL_READ_SUBSCRIPTIONS,
     AuthScope.CHAT_EDIT
-]
+)
+
+def parse_env_list(env_key, default=''):
+    """Parse a comma-separated environment variable into a tuple of lowercase items"""
+    return tuple(item.strip().lower() for item in os.getenv(env_key, default).split(',') if item.strip())
 
 # Get channels from environment (comma-separated list)
-CHANNELS = [channel.strip().lower() for channel in os.getenv('TWITCH_CHANNELS', '').split(',') if channel.strip()]
+CHANNELS = parse_env_list('TWITCH_CHANNELS')
 if not CHANNELS:
     logger.error("No channels specified in TWITCH_CHANNELS environment variable")
     exit(1)
 
 # Get silent channels from environment (comma-separated list)
-SILENT_CHANNELS = [channel.strip().lower() for channel in os.getenv('SILENT_CHANNELS', '').split(',') if channel.strip()]
-logger.info(f"Monitoring channels: {', '.join(CHANNELS)}")
-logger.info(f"Silent channels (no chat messages): {', '.join(SILENT_CHANNELS)}")
+SILENT_CHANNELS = parse_env_list('SILENT_CHANNELS')
+logger.info("Monitoring channels: %s", ', '.join(CHANNELS))
+logger.info("Silent channels (no chat messages): %s", ', '.join(SILENT_CHANNELS))
 
 # Combine all channels to monitor
-ALL_CHANNELS = list(set(CHANNELS + SILENT_CHANNELS))
+ALL_CHANNELS = frozenset(CHANNELS) | frozenset(SILENT_CHANNELS)
 
 # Get reaction keywords from environment (comma-separated list)
-REACTION_KEYWORDS = [keyword.strip().lower() for keyword in os.getenv('REACTION_KEYWORDS', 'lol,lmao,+2,lmfao').split(',')]
-logger.info(f"Monitoring for reaction keywords: {', '.join(REACTION_KEYWORDS)}")
+REACTION_KEYWORDS = parse_env_list('REACTION_KEYWORDS', 'lol,lmao,+2,lmfao')
+if not REACTION_KEYWORDS:
+    logger.error("No reaction keywords specified in REACTION_KEYWORDS environment variable")
+    exit(1)
+logger.info("Monitoring for reaction keywords: %s", ', '.join(REACTION_KEYWORDS))
+
+# Build the keyword matcher once so each message is scanned in a single pass
+KEYWORD_AUTOMATON = None
+KEYWORD_PATTERN = None
+if ahocorasick:
+    KEYWORD_AUTOMATON = ahocorasick.Automaton()
+    for keyword in REACTION_KEYWORDS:
+        KEYWORD_AUTOMATON.add_word(keyword, keyword)
+    KEYWORD_AUTOMATON.make_automaton()
+else:
+    KEYWORD_PATTERN = re.compile('|'.join(re.escape(keyword) for keyword in REACTION_KEYWORDS))
+
+# Shortest message that could hold a reaction keyword or a !village lookup
+MIN_MESSAGE_LENGTH = min(min(len(keyword) for keyword in REACTION_KEYWORDS), len("!village ") + 1)
+
+def has_reaction_keyword(text):
+    """Check whether the (lowercased) text contains any reaction keyword"""
+    if KEYWORD_AUTOMATON is not None:
+        return next(KEYWORD_AUTOMATON.iter(text), None) is not None
+    return KEYWORD_PATTERN.search(text) is not None
 
 # Reaction tracking settings
 REACTION_WINDOW = int(os.getenv('REACTION_WINDOW', '30'))  # seconds to count reactions
 REACTION_THRESHOLD = int(os.getenv('REACTION_THRESHOLD', '10'))  # number of reactions needed to trigger a clip
 COOLDOWN_PERIOD = int(os.getenv('COOLDOWN_PERIOD', '120'))  # seconds between clips to avoid spam
 CLIP_DELAY = 5  # seconds to wait before creating a clip after threshold is reached
+REACTION_LOG_STEP = max(1, REACTION_THRESHOLD // 4)  # log the reaction count each quarter of the way to the threshold
+
+# Twitch rate limit settings
+HELIX_LOGINS_PER_REQUEST = 100  # maximum logins accepted by a single get_users call
+TOKEN_PREFETCH_SECONDS = 7200  # refresh the access token this long before it expires
 
 # Load settlements database
 settlements = []
+settlement_labels = []  # Preprocessed labels in the same order as settlements, for fuzzy matching
+settlements_by_label = {}  # Lowercase label -> settlement, for exact matches
+settlement_trigrams = {}  # Trigram -> indices of the preprocessed labels containing it
+
+def trigrams(text):
+    """Return the set of padded 3-character substrings of text"""
+    padded = f"  {text} "  # Pad so the first and last letters also form trigrams
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
 
 def load_settlements():
     """Load settlement data from CSV file"""
-    global settlements
+    global settlements, settlement_labels, settlements_by_label, settlement_trigrams
     try:
         with open('database.csv', 'r', encoding='utf-8') as file:
             reader = csv.DictReader(file)
             settlements = [{'label': row['settlementLabel'], 'link': row['wikiLink']} for row in reader]
-        logger.info(f"✅ CSV loaded with {len(settlements)} settlements")
-    except Exception as e:
-        logger.error(f"Failed to load settlements database: {str(e)}")
-
-# Load the database on startup
-load_settlements()
 
+        # Build the lookup tables once instead of on every search
+        settlement_labels = [utils.default_process(s['label']) for s in settlements]
+        settlements_by_label = {}
+        for settlement in settlements:
+            settlements_by_label.setdefault(settlement['label'].lower(), settlement)
+        settlement_trigrams = {}
+        for index, label in enumerate(settlement_labels):
+            for trigram in trigrams(label):
+                settlement_trigrams.setdefault(trigram, []).append(index)
+        search_village.cache_clear()
+
+        logger.info("✅ CSV loaded with %s settlements", len(settlements))
+    except Exception:
+        logger.exception("Failed to load settlements database")
+
+@functools.lru_cache(maxsize=4096)
 def search_village(query):
-    """Search for a village using fuzzy matching"""
+    """Search for a village, trying an exact match before fuzzy matching"""
     if not settlements:
         return None
 
-    # Extract just the labels for searching
-    labels = [s['label'] for s in settlements]
+    # An exact (case-insensitive) name needs no fuzzy matching
+    settlement = settlements_by_label.get(query.lower())
+    if settlement:
+        return settlement
 
     # Use fuzzy matching to find best match
-    result = process.extractOne(query, labels, scorer=fuzz.WRatio, score_cutoff=50)
+    # Labels were preprocessed at load time, so only the query needs it here
+    processed_query = utils.default_process(query)
+
+    # Only score labels sharing a trigram with the query, falling back to a full scan.
+    # Queries of 3 characters or fewer match mostly on padding trigrams, so always scan those in full.
+    candidates = set()
+    if len(processed_query) > 3:
+        for trigram in trigrams(processed_query):
+            candidates.update(settlement_trigrams.get(trigram, ()))
+    if not candidates:
+        candidates = range(len(settlement_labels))
+    candidates = sorted(candidates)  # Keep CSV order so ties resolve as before
+
+    result = process.extractOne(processed_query, [settlement_labels[i] for i in candidates], scorer=fuzz.WRatio, processor=None, score_cutoff=50)
 
     if result:
-        matched_label, score, _ = result
-        # Find the full settlement data
-        for settlement in settlements:
-            if settlement['label'] == matched_label:
-                return settlement
+        _, _, position = result
+        return settlements[candidates[position]]
 
     return None
 
+# Load the database on startup
+load_settlements()
+
 # Channel-specific reaction tracking
 class ChannelState:
     def __init__(self, is_silent=False):
-        self.reaction_times = []
-        self.last_clip_time = datetime.now() - timedelta(seconds=COOLDOWN_PERIOD)
+        # Monotonic timestamps of recent reactions, oldest first. Only the newest
+        # REACTION_THRESHOLD ever matter for reaching the threshold.
+        self.reaction_times = collections.deque(maxlen=REACTION_THRESHOLD)
+        self.last_clip_time = time.monotonic() - COOLDOWN_PERIOD
         self.silence_mode = is_silent  # Whether to suppress chat messages
+        self.broadcaster_id = None  # Resolved lazily, a channel's user ID never changes
+        self.last_logged_count = 0  # Reaction count at the last progress log
 
 # Dictionary to track state for each channel
 channel_states = {}
@@ -118,21 +212,55 @@ for channel in SILENT_CHANNELS:
 # Global variables
 twitch = None
 chat = None
-last_token_refresh = datetime.now()
+last_token_refresh = time.monotonic()  # Monotonic time of the last refresh token update
 # Track when the refresh token was last used with TwitchTokenGenerator
 # Initialize with a date 30 days ago to ensure we refresh within 30 days
 last_ttg_refresh = datetime.now() - timedelta(days=30)
+# Monotonic time the current access token expires, if known; lets the scheduler skip validation
+token_expires_at = None
+# In-flight token refresh shared by concurrent callers of ensure_fresh_token
+token_refresh_task = None
+# Set to wake the scheduled token refresh early, created when the scheduler starts
+token_refresh_event = None
+
+# Shared HTTP session, created lazily so it binds to the running event loop
+_session: Optional[aiohttp.ClientSession] = None
+
+async def get_session():
+    """Return the shared aiohttp session, creating it on first use"""
+    global _session
+    if _session is None or _session.closed:
+        # Keep DNS answers and idle connections around longer than the defaults, token calls come in bursts
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=75, enable_cleanup_closed=True)
+        timeout = aiohttp.ClientTimeout(total=10, connect=5)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+async def close_session():
+    """Close the shared aiohttp session if it was opened"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+# Cached .env lines and the file's mtime when they were read or written
+env_lines = None
+env_mtime = None
 
 def update_env_file(access_token, refresh_token):
     """Update the .env file with new tokens"""
+    global env_lines, env_mtime
+    temp_path = None
     try:
-        # Read the current .env file
-        with open('.env', 'r') as f:
-            lines = f.readlines()
+        # Only re-read the .env file if it changed since we last touched it
+        env_stat = os.stat('.env')
+        if env_lines is None or env_stat.st_mtime != env_mtime:
+            with open('.env', 'r') as f:
+                env_lines = f.readlines()
 
         # Update the token lines
         new_lines = []
-        for line in lines:
+        for line in env_lines:
             if line.startswith('TWITCH_ACCESS_TOKEN='):
                 new_lines.append(f'TWITCH_ACCESS_TOKEN={access_token}\n')
             elif line.startswith('TWITCH_REFRESH_TOKEN='):
@@ -140,72 +268,160 @@ def update_env_file(access_token, refresh_token):
             else:
                 new_lines.append(line)
 
-        # Write the updated content back to the .env file
-        with open('.env', 'w') as f:
+        # Write to a temporary file and swap it in, so a crash can't leave a half-written .env
+        env_dir = os.path.dirname(os.path.abspath('.env'))
+        with tempfile.NamedTemporaryFile('w', dir=env_dir, prefix='.env.', suffix='.tmp', delete=False) as f:
+            temp_path = f.name
             f.writelines(new_lines)
+            # Get the new contents onto disk before the rename, or a power cut could leave an empty .env
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, stat.S_IMODE(env_stat.st_mode))
+        os.replace(temp_path, '.env')
+        temp_path = None
+
+        # Persist the rename itself (directories can't be opened for fsync on Windows)
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(env_dir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+        env_lines = new_lines
+        env_mtime = os.stat('.env').st_mtime
 
         logger.info("Updated .env file with new tokens")
         return True
-    except Exception as e:
-        logger.error(f"Failed to update .env file: {str(e)}")
+    except Exception:
+        logger.exception("Failed to update .env file")
+        if temp_path:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
         return False
 
-async def check_token_validity():
-    """Check if the provided tokens are valid and get expiration info"""
-    try:
-        # Initialize a temporary Twitch instance to validate tokens
-        temp_twitch = await Twitch(APP_ID, APP_SECRET)
-        temp_twitch.auto_refresh_auth = False  # Disable auto refresh
-
-        # Set the authentication with the tokens
-        await temp_twitch.set_user_authentication(ACCESS_TOKEN, USER_SCOPE, REFRESH_TOKEN)
-
-        # Try to make a simple API call to validate the token
-        user = await first(temp_twitch.get_users())
+ENV_WRITE_DELAY = 0.2  # seconds to wait for more token updates before writing .env
+pending_env_tokens = None  # Latest (access, refresh) pair waiting to be written
+env_write_task = None
+
+def schedule_env_update(access_token, refresh_token):
+    """Queue a .env token update, coalescing updates that arrive close together"""
+    global pending_env_tokens, env_write_task
+    pending_env_tokens = (access_token, refresh_token)
+    if env_write_task is None or env_write_task.done():
+        env_write_task = asyncio.ensure_future(write_env_after_delay())
+
+async def write_env_after_delay():
+    """Write the latest queued tokens once the burst of updates has settled"""
+    global pending_env_tokens
+    await asyncio.sleep(ENV_WRITE_DELAY)
+
+    # Write in a worker thread so file I/O doesn't stall chat handling; keep going
+    # if more tokens arrived while the previous write was running
+    loop = asyncio.get_running_loop()
+    while pending_env_tokens is not None:
+        access_token, refresh_token = pending_env_tokens
+        pending_env_tokens = None
+        await loop.run_in_executor(None, update_env_file, access_token, refresh_token)
+
+async def flush_env_updates():
+    """Wait for any delayed .env write and write whatever is still queued"""
+    if env_write_task is not None and not env_write_task.done():
+        await env_write_task
+    write_pending_env_update()
+
+def write_pending_env_update():
+    """Write any queued tokens to the .env file"""
+    global pending_env_tokens
+    if pending_env_tokens is not None:
+        access_token, refresh_token = pending_env_tokens
+        pending_env_tokens = None
+        update_env_file(access_token, refresh_token)
+
+# Don't lose rotated tokens if the bot exits before the delayed write runs
+atexit.register(write_pending_env_update)
+
+def set_token_expiry(expires_in_seconds):
+    """Remember when the current access token expires (None if unknown)"""
+    global token_expires_at
+    if expires_in_seconds is None:
+        token_expires_at = None
+    else:
+        token_expires_at = time.monotonic() + expires_in_seconds
+
+def store_tokens(access_token, refresh_token, expires_in_seconds):
+    """Replace the current token pair in one step and queue it for the .env file"""
+    global ACCESS_TOKEN, REFRESH_TOKEN, last_token_refresh
+    # No awaits here, so no other coroutine can see a new access token with an old refresh token
+    ACCESS_TOKEN = access_token
+    REFRESH_TOKEN = refresh_token
+    last_token_refresh = time.monotonic()
+    set_token_expiry(expires_in_seconds)
+    schedule_env_update(access_token, refresh_token)
 
-        if user:
-            # Token is valid, now get expiration info
-            # We'll use the validate endpoint to get token info
-            headers = {
-                'Authorization': f'OAuth {ACCESS_TOKEN}'
-            }
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get('https://id.twitch.tv/oauth2/validate', headers=headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-
-                        # Extract expiration info
-                        if 'expires_in' in data:
-                            expires_in_seconds = data['expires_in']
-                            expiration_date = datetime.now() + timedelta(seconds=expires_in_seconds)
-
-                            # Format expiration date
-                            formatted_date = expiration_date.strftime('%Y-%m-%d %H:%M:%S')
-                            logger.info(f"Token is valid! Expires on: {formatted_date} (in {expires_in_seconds//86400} days, {(expires_in_seconds%86400)//3600} hours)")
-
-                            # Also log the scopes
-                            if 'scopes' in data:
-                                logger.info(f"Token scopes: {', '.join(data['scopes'])}")
-
-                            # Return both validity and expiration time
-                            return True, expires_in_seconds
-                        else:
-                            logger.info("Token is valid, but couldn't determine expiration time")
-                            return True, None
-                    else:
-                        logger.error(f"Failed to validate token: {response.status}")
-                        return False, None
+def missing_required_scopes(token_scopes):
+    """Return the scopes the bot needs that token_scopes doesn't include"""
+    return [scope.value for scope in USER_SCOPE if scope.value not in token_scopes]
 
-        await temp_twitch.close()
-        return False, None
-    except Exception as e:
-        logger.error(f"Error checking token validity: {str(e)}")
-        return False, None
+async def check_token_validity():
+    """Check if the provided tokens are valid, returning (valid, expires_in_seconds, needs_new_token)"""
+    try:
+        # The validate endpoint rejects invalid tokens and reports scopes and
+        # expiration for valid ones, so a single request covers everything
+        headers = {
+            'Authorization': f'OAuth {ACCESS_TOKEN}'
+        }
+
+        session = await get_session()
+        async with session.get('https://id.twitch.tv/oauth2/validate', headers=headers) as response:
+            if response.status == 200:
+                data = orjson.loads(await response.read())
+
+                # The bot needs a user token issued to its own client; refreshing can't change either
+                if 'user_id' not in data:
+                    logger.error("Token is not a user access token")
+                    return False, None, True
+                if data.get('client_id') != APP_ID:
+                    logger.error("Token was issued to a different client ID than TWITCH_CLIENT_ID")
+                    return False, None, True
+
+                # Make sure the token carries every scope the bot needs
+                token_scopes = data.get('scopes', [])
+                missing_scopes = missing_required_scopes(token_scopes)
+                if missing_scopes:
+                    logger.error("Token is missing required scopes: %s", ', '.join(missing_scopes))
+                    return False, None, True  # Reported separately, refreshing can't add scopes
+
+                # Extract expiration info
+                if 'expires_in' in data:
+                    expires_in_seconds = data['expires_in']
+                    set_token_expiry(expires_in_seconds)
+
+                    # Only build the expiry date and scope list if they will be logged
+                    if logger.isEnabledFor(logging.INFO):
+                        expires_at = (datetime.now() + timedelta(seconds=expires_in_seconds)).isoformat(' ', 'seconds')
+                        logger.info("Token is valid! Expires on: %s (in %s days, %s hours)", expires_at, expires_in_seconds//86400, (expires_in_seconds%86400)//3600)
+
+                        # Also log the scopes
+                        logger.info("Token scopes: %s", ', '.join(token_scopes))
+
+                    # Return both validity and expiration time
+                    return True, expires_in_seconds, False
+                else:
+                    logger.info("Token is valid, but couldn't determine expiration time")
+                    return True, None, False
+            else:
+                logger.error("Failed to validate token: %s", response.status)
+                return False, None, False
+    except Exception:
+        logger.exception("Error checking token validity")
+        return False, None, False
 
 async def refresh_with_twitchtokengenerator():
     """Refresh the token using TwitchTokenGenerator's refresh API"""
-    global ACCESS_TOKEN, REFRESH_TOKEN, last_token_refresh, last_ttg_refresh
+    global last_ttg_refresh
 
     try:
         logger.info("Refreshing token using TwitchTokenGenerator...")
@@ -213,98 +429,88 @@ async def refresh_with_twitchtokengenerator():
         # Use TwitchTokenGenerator's refresh API
         refresh_url = f"https://twitchtokengenerator.com/api/refresh/{REFRESH_TOKEN}"
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(refresh_url) as response:
-                if response.status == 200:
-                    result = await response.json()
-
-                    # Check if the refresh was successful
-                    if result.get('success') == True:
-                        # Extract the new tokens
-                        token_data = result.get('token', {})
-                        new_access_token = token_data.get('access_token')
-                        new_refresh_token = token_data.get('refresh_token')
-
-                        if new_access_token and new_refresh_token:
-                            # Update global variables
-                            ACCESS_TOKEN = new_access_token
-                            REFRESH_TOKEN = new_refresh_token
-                            last_token_refresh = datetime.now()
-                            last_ttg_refresh = datetime.now()  # Update the TTG refresh timestamp
-
-                            # Update the .env file
-                            update_env_file(new_access_token, new_refresh_token)
-
-                            # Update the twitch instance with the new tokens
-                            if twitch:  # Only if twitch instance exists
-                                await twitch.set_user_authentication(ACCESS_TOKEN, USER_SCOPE, REFRESH_TOKEN)
-
-                            logger.info(f"Token refreshed with TwitchTokenGenerator at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-                            logger.info("Access token refreshed and refresh token updated with TwitchTokenGenerator")
-                            return True
-                        else:
-                            logger.error("Failed to extract new tokens from TwitchTokenGenerator response")
+        session = await get_session()
+        async with session.get(refresh_url) as response:
+            if response.status == 200:
+                result = orjson.loads(await response.read())
+
+                # Check if the refresh was successful
+                if result.get('success') == True:
+                    # Extract the new tokens
+                    token_data = result.get('token', {})
+                    new_access_token = token_data.get('access_token')
+                    new_refresh_token = token_data.get('refresh_token')
+
+                    if new_access_token and new_refresh_token:
+                        # Only trust the expiry if the scopes are confirmed too, otherwise the next validation checks them
+                        expires_in = None if missing_required_scopes(token_data.get('scope', ())) else token_data.get('expires_in')
+                        store_tokens(new_access_token, new_refresh_token, expires_in)
+                        last_ttg_refresh = datetime.now()  # Update the TTG refresh timestamp
+
+                        # Update the twitch instance with the new tokens
+                        if twitch:  # Only if twitch instance exists
+                            await twitch.set_user_authentication(ACCESS_TOKEN, USER_SCOPE, REFRESH_TOKEN)
+
+                        logger.info("Token refreshed with TwitchTokenGenerator at %s", datetime.now())
+                        logger.info("Access token refreshed and refresh token updated with TwitchTokenGenerator")
+                        return True
                     else:
-                        error_msg = result.get('message', 'Unknown error')
-                        logger.error(f"TwitchTokenGenerator refresh failed: {error_msg}")
+                        logger.error("Failed to extract new tokens from TwitchTokenGenerator response")
                 else:
-                    error_text = await response.text()
-                    logger.error(f"TwitchTokenGenerator refresh failed: {response.status} - {error_text}")
+                    error_msg = result.get('message', 'Unknown error')
+                    logger.error("TwitchTokenGenerator refresh failed: %s", error_msg)
+            else:
+                error_text = await response.text()
+                logger.error("TwitchTokenGenerator refresh failed: %s - %s", response.status, error_text)
 
-                return False
-    except Exception as e:
-        logger.error(f"Error refreshing token with TwitchTokenGenerator: {str(e)}")
+            return False
+    except Exception:
+        logger.exception("Error refreshing token with TwitchTokenGenerator")
         return False
 
 async def refresh_with_twitch_api():
     """Refresh the token directly using Twitch's OAuth API"""
-    global ACCESS_TOKEN, REFRESH_TOKEN, last_token_refresh
-
     try:
         logger.info("Attempting to refresh token directly with Twitch API...")
 
         # Use the Twitch OAuth API to refresh the token
-        async with aiohttp.ClientSession() as session:
-            data = {
-                'client_id': APP_ID,
-                'client_secret': APP_SECRET,
-                'grant_type': 'refresh_token',
-                'refresh_token': REFRESH_TOKEN
-            }
-
-            async with session.post('https://id.twitch.tv/oauth2/token', data=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-
-                    # Update the tokens
-                    new_access_token = result.get('access_token')
-                    new_refresh_token = result.get('refresh_token')
-
-                    if new_access_token and new_refresh_token:
-                        # Update global variables
-                        ACCESS_TOKEN = new_access_token
-                        REFRESH_TOKEN = new_refresh_token
-                        last_token_refresh = datetime.now()
-
-                        # Update the .env file
-                        update_env_file(new_access_token, new_refresh_token)
-
-                        # Update the twitch instance with the new tokens
-                        if twitch:  # Only if twitch instance exists
-                            await twitch.set_user_authentication(ACCESS_TOKEN, USER_SCOPE, REFRESH_TOKEN)
-
-                        logger.info(f"Token refreshed directly with Twitch API at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-                        logger.info("Access token refreshed and refresh token updated with Twitch API")
-                        return True
-                    else:
-                        logger.error("Failed to get new tokens from Twitch API response")
-                        return False
+        session = await get_session()
+        data = {
+            'client_id': APP_ID,
+            'client_secret': APP_SECRET,
+            'grant_type': 'refresh_token',
+            'refresh_token': REFRESH_TOKEN
+        }
+
+        async with session.post('https://id.twitch.tv/oauth2/token', data=data) as response:
+            if response.status == 200:
+                result = orjson.loads(await response.read())
+
+                # Update the tokens
+                new_access_token = result.get('access_token')
+                new_refresh_token = result.get('refresh_token')
+
+                if new_access_token and new_refresh_token:
+                    # Only trust the expiry if the scopes are confirmed too, otherwise the next validation checks them
+                    expires_in = None if missing_required_scopes(result.get('scope', ())) else result.get('expires_in')
+                    store_tokens(new_access_token, new_refresh_token, expires_in)
+
+                    # Update the twitch instance with the new tokens
+                    if twitch:  # Only if twitch instance exists
+                        await twitch.set_user_authentication(ACCESS_TOKEN, USER_SCOPE, REFRESH_TOKEN)
+
+                    logger.info("Token refreshed directly with Twitch API at %s", datetime.now())
+                    logger.info("Access token refreshed and refresh token updated with Twitch API")
+                    return True
                 else:
-                    error_text = await response.text()
-                    logger.error(f"Twitch API token refresh failed: {response.status} - {error_text}")
+                    logger.error("Failed to get new tokens from Twitch API response")
                     return False
-    except Exception as e:
-        logger.error(f"Error refreshing token with Twitch API: {str(e)}")
+            else:
+                error_text = await response.text()
+                logger.error("Twitch API token refresh failed: %s - %s", response.status, error_text)
+                return False
+    except Exception:
+        logger.exception("Error refreshing token with Twitch API")
         return False
 
 def print_token_renewal_instructions():
@@ -328,232 +534,294 @@ def print_token_renewal_instructions():
     logger.error("After updating the .env file, restart the bot.")
     logger.error("=====================================")
 
+async def ensure_fresh_token(reason):
+    """Refresh the token, joining a refresh that is already in flight instead of starting another"""
+    global token_refresh_task
+    if token_refresh_task is None or token_refresh_task.done():
+        token_refresh_task = asyncio.ensure_future(refresh_token_with_retries(reason))
+    else:
+        logger.info("Token refresh (%s) joining the refresh already in progress", reason)
+
+    # Shield the shared refresh so one cancelled caller doesn't cancel it for everyone
+    return await asyncio.shield(token_refresh_task)
+
+async def refresh_token_with_retries(reason):
+    """Refresh the token with the Twitch API, falling back to TwitchTokenGenerator, retrying with backoff"""
+    for attempt in range(3):
+        if attempt:
+            # Back off about 2s, then 4s, with jitter so an outage isn't hammered in lockstep
+            await asyncio.sleep(2 ** attempt + random.uniform(0, 1))
+
+        logger.info("Refreshing token (%s), attempt %d", reason, attempt + 1)
+        # Try direct Twitch API refresh first
+        if await refresh_with_twitch_api():
+            return True
+
+        # If direct refresh fails, try TwitchTokenGenerator as fallback
+        logger.warning("Direct Twitch API refresh failed, trying TwitchTokenGenerator")
+        if await refresh_with_twitchtokengenerator():
+            return True
+
+    logger.error("Token refresh (%s) failed after 3 attempts", reason)
+    return False
+
+async def validate_and_refresh_token():
+    """Validate the access token and refresh it if it is close to expiring"""
+    token_valid, expires_in_seconds, needs_new_token = await check_token_validity()
+
+    if needs_new_token:
+        # A refreshed token keeps the same client and scopes, so only a new token helps
+        print_token_renewal_instructions()
+    elif not token_valid:
+        logger.warning("Token validation failed, attempting refresh...")
+        await ensure_fresh_token("validation failed")
+    elif expires_in_seconds is not None:
+        # If less than 2 hours left, refresh the token
+        if expires_in_seconds < TOKEN_PREFETCH_SECONDS:
+            logger.info("Token expires in %s seconds, refreshing...", expires_in_seconds)
+            await ensure_fresh_token("expiry")
+        else:
+            logger.info("Token still valid for %s hours, no refresh needed", expires_in_seconds//3600)
+
+def next_token_check_delay():
+    """Seconds until the scheduled token refresh next needs to run"""
+    now = time.monotonic()
+
+    # Without a known expiry, validate once an hour
+    delay = 3600
+    if token_expires_at is not None:
+        # Wake up when the token enters the prefetch window
+        delay = token_expires_at - TOKEN_PREFETCH_SECONDS - now
+
+    # Never sleep past the 30-day refresh token deadline. Once it has passed and the
+    # refresh keeps failing, retry hourly rather than every minute.
+    until_30_days = last_token_refresh + 30 * 86400 - now
+    if until_30_days > 0:
+        delay = min(delay, until_30_days)
+    else:
+        delay = min(delay, 3600)
+    return max(60, delay)
+
+def request_token_refresh():
+    """Wake the scheduled token refresh so it validates the token right away"""
+    if token_refresh_event is not None:
+        token_refresh_event.set()
+
 async def scheduled_token_refresh():
-    """Periodically refresh the token to ensure it never expires"""
+    """Refresh the token shortly before it expires, or sooner when requested"""
+    global token_refresh_event
+    token_refresh_event = asyncio.Event()
+
     while True:
         try:
-            # Wait for 1 hour between checks
-            await asyncio.sleep(3600)  # 3600 seconds = 1 hour
-
-            current_time = datetime.now()
-
-            # Check if the access token is close to expiring
-            headers = {
-                'Authorization': f'OAuth {ACCESS_TOKEN}'
-            }
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get('https://id.twitch.tv/oauth2/validate', headers=headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-
-                        # Extract expiration info
-                        if 'expires_in' in data:
-                            expires_in_seconds = data['expires_in']
-
-                            # If less than 2 hours left, refresh the token
-                            if expires_in_seconds < 7200:  # 7200 seconds = 2 hours
-                                logger.info(f"Token expires in {expires_in_seconds} seconds, refreshing...")
-                                # Try direct Twitch API refresh first
-                                twitch_api_success = await refresh_with_twitch_api()
-
-                                # If direct refresh fails, try TwitchTokenGenerator as fallback
-                                if not twitch_api_success:
-                                    logger.warning("Direct Twitch API refresh failed, trying TwitchTokenGenerator")
-                                    await refresh_with_twitchtokengenerator()
-                            else:
-                                logger.info(f"Token still valid for {expires_in_seconds//3600} hours, no refresh needed")
-                    else:
-                        # If validation fails, try direct Twitch API refresh first
-                        logger.warning(f"Token validation failed, attempting direct refresh with Twitch API...")
-                        twitch_api_success = await refresh_with_twitch_api()
-
-                        # If direct refresh fails, try TwitchTokenGenerator as fallback
-                        if not twitch_api_success:
-                            logger.warning("Direct Twitch API refresh failed, trying TwitchTokenGenerator")
-                            await refresh_with_twitchtokengenerator()
+            # Sleep until the token needs attention or someone requests an early check
+            try:
+                await asyncio.wait_for(token_refresh_event.wait(), timeout=next_token_check_delay())
+                token_refresh_event.clear()
+                logger.info("Early token check requested")
+                set_token_expiry(None)  # Don't trust the cached expiry, validate now
+            except asyncio.TimeoutError:
+                pass
+
+            # With a known expiry, refresh at the deadline without asking Twitch again
+            if token_expires_at is None:
+                await validate_and_refresh_token()
+            else:
+                expires_in_seconds = token_expires_at - time.monotonic()
+                if expires_in_seconds > TOKEN_PREFETCH_SECONDS:
+                    logger.info("Token still valid for %d minutes, no refresh needed", expires_in_seconds // 60)
+                else:
+                    logger.info("Token expires in %d seconds, refreshing...", expires_in_seconds)
+                    if not await ensure_fresh_token("expiry"):
+                        set_token_expiry(None)  # Fall back to hourly validation until a refresh succeeds
 
             # Check if it's been more than 30 days since our last refresh token update
             # This ensures we refresh the token at least every 30 days to reset the 60-day countdown
-            days_since_last_refresh = (current_time - last_token_refresh).days
+            days_since_last_refresh = int((time.monotonic() - last_token_refresh) // 86400)
             if days_since_last_refresh >= 30:
-                logger.info(f"It's been {days_since_last_refresh} days since the last token refresh")
+                logger.info("It's been %d days since the last token refresh", days_since_last_refresh)
                 logger.info("Performing scheduled refresh to reset 60-day countdown")
-                # Try direct Twitch API refresh first
-                twitch_api_success = await refresh_with_twitch_api()
-
-                # If direct refresh fails, try TwitchTokenGenerator as fallback
-                if not twitch_api_success:
-                    logger.warning("Direct Twitch API refresh failed, trying TwitchTokenGenerator")
-                    await refresh_with_twitchtokengenerator()
+                await ensure_fresh_token("30-day refresh")
 
-        except Exception as e:
-            logger.error(f"Error in scheduled token refresh: {str(e)}")
-            # Try to refresh with direct Twitch API if there was an error
+        except Exception:
+            logger.exception("Error in scheduled token refresh")
+            # Try to refresh the token if there was an error
             try:
-                twitch_api_success = await refresh_with_twitch_api()
-                # If direct refresh fails, try TwitchTokenGenerator as fallback
-                if not twitch_api_success:
-                    logger.warning("Direct Twitch API refresh failed, trying TwitchTokenGenerator")
-                    await refresh_with_twitchtokengenerator()
-            except Exception as inner_e:
-                logger.error(f"Failed to refresh token after error: {str(inner_e)}")
+                await ensure_fresh_token("scheduler error")
+            except Exception:
+                logger.exception("Failed to refresh token after error")
+
+def chunks(items, size):
+    """Split an iterable into consecutive lists of at most size items"""
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+async def prefetch_broadcaster_ids():
+    """Resolve the user IDs for monitored channels with batched get_users calls"""
+    # IDs never change, so a reconnect only needs to look up channels that failed before
+    unresolved = [channel for channel in ALL_CHANNELS if channel_states[channel].broadcaster_id is None]
+    for batch in chunks(unresolved, HELIX_LOGINS_PER_REQUEST):
+        try:
+            async for user in twitch.get_users(logins=batch):
+                state = channel_states.get(user.login.lower())
+                if state:
+                    state.broadcaster_id = user.id
+        except Exception:
+            logger.exception("Error resolving user IDs for %s", ', '.join(batch))
 
 async def on_ready(ready_event: EventData):
-    logger.info(f'Bot is ready!')
+    logger.info('Bot is ready!')
+
+    # Look up every channel's user ID up front so the clip path doesn't have to
+    await prefetch_broadcaster_ids()
 
-    # Join all channels
-    for channel in ALL_CHANNELS:
-        # Updated method name from join_channel to join_room
-        await chat.join_room(channel)
-        logger.info(f'Joined channel: {channel}')
+    # join_room takes the whole list and keeps within Twitch's JOIN rate limit itself
+    try:
+        failed = await chat.join_room(list(ALL_CHANNELS))
+    except Exception:
+        logger.exception("Error joining channels")
+        return
+
+    # join_room returns the rooms it could not join
+    for channel in failed:
+        logger.error("Failed to join channel %s", channel)
+    logger.info("Joined %d of %d channels", len(ALL_CHANNELS) - len(failed), len(ALL_CHANNELS))
 
 async def on_message(msg: ChatMessage):
     try:
         # Get the channel name from the room object
-        if hasattr(msg, 'room') and hasattr(msg.room, 'name'):
+        try:
             channel = msg.room.name
-            channel_lower = channel.lower()
-
-            # Check if this is a channel we're monitoring
-            if channel_lower in ALL_CHANNELS:
-                # Check for silence command (as a regular message)
-                if msg.text.lower().strip() == "!silence":
-                    # Check if the sender is the channel owner or a moderator
-                    if (hasattr(msg, 'author') and 
-                        (msg.author.name.lower() == channel_lower or 
-                         (hasattr(msg.author, 'is_mod') and msg.author.is_mod))):
-
-                        state = channel_states[channel_lower]
-                        was_silenced = state.silence_mode
-                        state.silence_mode = True
-                        logger.info(f"Silence mode activated for channel {channel}")
-
-                        # Send a message that the bot will be silent
-                        if not was_silenced:  # Only send if we weren't already silenced
-                            try:
-                                await chat.send_message(channel, "I'll be quiet until I'm restarted, but I'll still create clips!")
-                            except Exception as e:
-                                logger.error(f"Error sending silence message to {channel}: {str(e)}")
-                    return
-
-                # Check for !village command
-                if msg.text.lower().startswith("!village "):
-                    village_query = msg.text[9:].strip()  # Remove "!village " prefix
-
-                    if not village_query:
-                        if not channel_states[channel_lower].silence_mode:
-                            await chat.send_message(channel, f"@{msg.user.name} Please specify a village name.")
-                        return
-
-                    # Search for the village
-                    result = search_village(village_query)
-
-                    if result:
-                        response = f"@{msg.user.name} {result['label']}: {result['link']}"
-                    else:
-                        response = f"@{msg.user.name} Place not found."
-
-                    # Send response (unless in silence mode)
-                    if not channel_states[channel_lower].silence_mode:
-                        try:
-                            await chat.send_message(channel, response)
-                            logger.info(f"Village lookup in {channel}: '{village_query}' -> {result['label'] if result else 'Not found'}")
-                        except Exception as e:
-                            logger.error(f"Error sending village response to {channel}: {str(e)}")
-                    return
-
-                # Check if message contains any reaction keywords
-                message_lower = msg.text.lower()
-                for keyword in REACTION_KEYWORDS:
-                    if keyword in message_lower:
-                        logger.info(f"Reaction detected in {channel}: {msg.text}")
-                        await process_reaction(channel_lower)
-                        break
-    except Exception as e:
-        logger.error(f"Error processing message: {str(e)}")
-
-async def process_reaction(channel):
-    # Get channel state
-    state = channel_states[channel]
+        except AttributeError:
+            return
+        # Room names are already lowercase logins, so only lower them when needed
+        channel_lower = channel if channel in ALL_CHANNELS else channel.lower()
 
-    current_time = datetime.now()
-    state.reaction_times.append(current_time)
+        # Ignore rooms we aren't monitoring before touching the message text
+        state = channel_states.get(channel_lower)
+        if state is None:
+            return
 
-    # Remove reactions outside the time window
-    state.reaction_times = [t for t in state.reaction_times if (current_time - t).total_seconds() <= REACTION_WINDOW]
+        # Too short to be a reaction or a command, skip it without lowercasing
+        text = msg.text
+        if len(text) < MIN_MESSAGE_LENGTH:
+            return
 
-    # Log reaction count
-    if len(state.reaction_times) % 5 == 0:  # Log every 5 reactions to reduce spam
-        logger.info(f'Channel {channel} - Current reaction count: {len(state.reaction_times)}')
+        # Check for !village command, only lowercasing the prefix of '!' messages
+        if text[0] == "!" and text[:9].lower() == "!village ":
+            village_query = text[9:].strip()  # Remove "!village " prefix
+
+            if not village_query:
+                if not state.silence_mode:
+                    await chat.send_message(channel, f"@{msg.user.name} Please specify a village name.")
+                return
+
+            # Search for the village
+            result = search_village(village_query)
+
+            if result:
+                response = f"@{msg.user.name} {result['label']}: {result['link']}"
+            else:
+                response = f"@{msg.user.name} Place not found."
+
+            # Send response (unless in silence mode)
+            if not state.silence_mode:
+                try:
+                    await chat.send_message(channel, response)
+                    logger.info("Village lookup in %s: '%s' -> %s", channel, village_query, result['label'] if result else 'Not found')
+                except Exception:
+                    logger.exception("Error sending village response to %s", channel)
+            return
+
+        # Check if message contains any reaction keywords
+        if has_reaction_keyword(text.lower()):
+            # Per-message detail is debug-only; process_reaction logs the climbing count
+            logger.debug("Reaction detected in %s: %s", channel, msg.text)
+            await process_reaction(channel_lower, state)
+    except Exception:
+        logger.exception("Error processing message")
+
+async def process_reaction(channel, state):
+    now = time.monotonic()
+    reaction_times = state.reaction_times
+    reaction_times.append(now)
+
+    # Remove reactions outside the time window
+    cutoff = now - REACTION_WINDOW
+    while reaction_times and reaction_times[0] < cutoff:
+        reaction_times.popleft()
+
+    # Log reaction count as it climbs toward the threshold
+    reaction_count = len(reaction_times)
+    if reaction_count < state.last_logged_count:
+        state.last_logged_count = reaction_count  # Window decayed, count up from here
+    elif reaction_count >= state.last_logged_count + REACTION_LOG_STEP:
+        state.last_logged_count = reaction_count
+        logger.info('Channel %s - Current reaction count: %s', channel, reaction_count)
 
     # Check if we should create a clip
-    if len(state.reaction_times) >= REACTION_THRESHOLD:
+    if reaction_count >= REACTION_THRESHOLD:
         # Check if we're not in cooldown
-        if (current_time - state.last_clip_time).total_seconds() >= COOLDOWN_PERIOD:
-            logger.info(f'Channel {channel} - Reaction threshold reached! Checking if channel is live...')
+        if now - state.last_clip_time >= COOLDOWN_PERIOD:
+            logger.info('Channel %s - Reaction threshold reached! Checking if channel is live and waiting %s seconds before creating clip...', channel, CLIP_DELAY)
 
             # Always update the last clip time to prevent spam attempts
-            state.last_clip_time = current_time
+            state.last_clip_time = now
 
-            # Check if channel is live
-            is_live = await check_if_live(channel)
-            if is_live:
-                logger.info(f'Channel {channel} is live! Waiting {CLIP_DELAY} seconds before creating clip...')
-
-                # Wait for the specified delay before creating the clip
-                await asyncio.sleep(CLIP_DELAY)
-
-                logger.info(f'Channel {channel} - Creating clip now...')
-                clip_success = await create_clip_and_share(channel)
+            # Check if channel is live while the clip delay runs, keeping the stream for the clip's uptime
+            stream, _ = await asyncio.gather(get_stream_info(channel), asyncio.sleep(CLIP_DELAY))
+            if stream:
+                logger.info('Channel %s is live - Creating clip now...', channel)
+                clip_success = await create_clip_and_share(channel, stream)
 
                 # Only reset reaction counter if clip was successful
                 if clip_success:
-                    state.reaction_times = []
+                    state.reaction_times.clear()
+                    state.last_logged_count = 0
                 else:
                     # If clip failed, reduce the cooldown to allow another attempt sooner
                     # Set to 30 seconds instead of the full cooldown
-                    state.last_clip_time = current_time - timedelta(seconds=COOLDOWN_PERIOD - 30)
-                    logger.info(f"Channel {channel} - Clip creation failed, reducing cooldown to 30 seconds")
+                    state.last_clip_time = now - (COOLDOWN_PERIOD - 30)
+                    logger.info("Channel %s - Clip creation failed, reducing cooldown to 30 seconds", channel)
             else:
-                logger.info(f'Channel {channel} is not live, cannot create clip')
+                logger.info('Channel %s is not live, cannot create clip', channel)
+
+async def resolve_broadcaster_id(channel):
+    """Return the cached user ID for a channel, looking it up on first use"""
+    state = channel_states[channel]
+    if state.broadcaster_id is None:
+        user = await first(twitch.get_users(logins=[channel]))
+        if user:
+            state.broadcaster_id = user.id
+    return state.broadcaster_id
 
-async def check_if_live(channel):
+async def get_stream_info(channel):
+    """Return the channel's current stream, or None if it isn't live"""
     try:
         # Get user ID from channel name
-        user = await first(twitch.get_users(logins=[channel]))
-        if not user:
-            logger.error(f"Could not find user ID for {channel}")
-            return False
+        broadcaster_id = await resolve_broadcaster_id(channel)
+        if not broadcaster_id:
+            logger.error("Could not find user ID for %s", channel)
+            return None
 
         # Check if stream is live - using a more robust approach
         try:
             # Try using first() with get_streams
-            stream = await first(twitch.get_streams(user_id=[user.id]))
-            return stream is not None
-        except Exception as e:
-            logger.error(f"Error in get_streams call: {str(e)}")
+            return await first(twitch.get_streams(user_id=[broadcaster_id]))
+        except Exception:
+            logger.exception("Error in get_streams call")
 
             # Alternative approach: iterate through the async generator
-            is_live = False
-            async for stream in twitch.get_streams(user_id=[user.id]):
-                is_live = True
-                break
-            return is_live
-    except Exception as e:
-        logger.error(f"Error checking if channel {channel} is live: {str(e)}")
-        return False
+            async for stream in twitch.get_streams(user_id=[broadcaster_id]):
+                return stream
+            return None
+    except Exception:
+        logger.exception("Error checking if channel %s is live", channel)
+        return None
 
-async def get_stream_uptime(channel):
+def get_stream_uptime(stream):
     """Get the current uptime of the stream in HH:MM:SS format"""
     try:
-        # Get user ID from channel name
-        user = await first(twitch.get_users(logins=[channel]))
-        if not user:
-            return "Unknown"
-
-        # Get stream info
-        stream = await first(twitch.get_streams(user_id=[user.id]))
         if not stream:
             return "Unknown"
 
@@ -566,94 +834,119 @@ async def get_stream_uptime(channel):
         hours, remainder = divmod(uptime.total_seconds(), 3600)
         minutes, seconds = divmod(remainder, 60)
         return f"{int(hours):02d}:{int(minutes):02d}:{int(seconds):02d}"
-    except Exception as e:
-        logger.error(f"Error getting stream uptime: {str(e)}")
+    except Exception:
+        logger.exception("Error getting stream uptime")
         return "Unknown"
 
-async def create_clip_and_share(channel):
+def extract_clip_id(clip_data):
+    """Get the clip ID from a create_clip response"""
     try:
-        # Get user ID from channel name
-        user = await first(twitch.get_users(logins=[channel]))
-        if not user:
-            logger.error(f"Could not find user ID for {channel}")
-            return False
+        # Current twitchAPI versions return a single CreatedClip object
+        return clip_data.id
+    except AttributeError:
+        pass
+
+    # Fall back to the shapes returned by older versions of the library
+    if isinstance(clip_data, list) and len(clip_data) > 0:
+        return clip_data[0].id
+    if isinstance(clip_data, dict):
+        return clip_data.get('id')
+    return None
 
-        # Get stream uptime for clip title
-        uptime = await get_stream_uptime(channel)
-        clip_title = f"{channel} - {uptime}"
+async def create_clip_and_share(channel, stream):
+    try:
+        # The live stream already carries the broadcaster's user ID
+        broadcaster_id = stream.user_id
+
+        # Get stream uptime for the chat message
+        uptime = get_stream_uptime(stream)
 
         # Create the clip
         try:
             # Create clip with a 60-second duration (the API will use the maximum allowed)
             clip_data = await twitch.create_clip(
-                broadcaster_id=user.id,
+                broadcaster_id=broadcaster_id,
                 has_delay=True  # This adds a delay to capture more recent content
             )
 
             # Debug the clip data
-            logger.debug(f"Clip data: {clip_data}")
+            logger.debug("Clip data: %s", clip_data)
 
             # Check if we got clip data
             if clip_data:
-                # Handle different return types from the API
-                if isinstance(clip_data, list) and len(clip_data) > 0:
-                    clip_id = clip_data[0].id
-                elif hasattr(clip_data, 'id'):
-                    # If it's a single object with an id attribute
-                    clip_id = clip_data.id
-                else:
-                    # Try to access it as a dictionary
-                    clip_id = clip_data['id'] if isinstance(clip_data, dict) and 'id' in clip_data else None
+                clip_id = extract_clip_id(clip_data)
 
                 if not clip_id:
-                    logger.error(f"Channel {channel} - Failed to extract clip ID from response: {clip_data}")
+                    logger.error("Channel %s - Failed to extract clip ID from response: %s", channel, clip_data)
                     return False
 
                 clip_url = f"https://clips.twitch.tv/{clip_id}"
-                logger.info(f"Channel {channel} - Clip created successfully! ID: {clip_id}")
-                logger.info(f"Clip will be available at: {clip_url}")
+                logger.info("Channel %s - Clip created successfully! ID: %s", channel, clip_id)
+                logger.info("Clip will be available at: %s", clip_url)
 
                 # Send clip URL to chat with the timestamp, but only if not in silence mode
                 if not channel_states[channel].silence_mode:
                     chat_message = f"Clip created at {uptime} into the stream! Watch it here: {clip_url}"
                     try:
                         await chat.send_message(channel, chat_message)
-                    except Exception as e:
-                        logger.error(f"Error sending clip message to {channel}: {str(e)}")
+                    except Exception:
+                        logger.exception("Error sending clip message to %s", channel)
 
                 # Twitch needs time to process the clip
-                logger.info(f"Channel {channel} - Clip is processing and will be available shortly")
+                logger.info("Channel %s - Clip is processing and will be available shortly", channel)
                 return True
             else:
-                logger.error(f"Channel {channel} - Failed to create clip - no data returned")
+                logger.error("Channel %s - Failed to create clip - no data returned", channel)
                 return False
-        except Exception as e:
-            logger.error(f"Error in create_clip call: {str(e)}")
-            # Log the full exception for debugging
-            import traceback
-            logger.error(traceback.format_exc())
+        except UnauthorizedException:
+            logger.exception("Error in create_clip call for %s", channel)
+            request_token_refresh()  # The token was rejected, don't wait for the next scheduled check
+            return False
+        except Exception:
+            logger.exception("Error in create_clip call for %s", channel)
             return False
 
-    except Exception as e:
-        logger.error(f"Error creating clip for channel {channel}: {str(e)}")
+    except Exception:
+        logger.exception("Error creating clip for channel %s", channel)
         return False
 
+async def enter_silence(channel):
+    """Switch a channel to silence mode, announcing it the first time"""
+    state = channel_states.get(channel)
+    if state is None:
+        return
+
+    was_silenced = state.silence_mode
+    state.silence_mode = True
+    logger.info("Silence mode activated for channel %s", channel)
+
+    # Send a message that the bot will be silent
+    if not was_silenced:  # Only send if we weren't already silenced
+        try:
+            await chat.send_message(channel, "I'll be quiet until I'm restarted, but I'll still create clips!")
+        except Exception:
+            logger.exception("Error sending silence message to %s", channel)
+
 async def silence_command(cmd):
     channel = cmd.room.name.lower()
-    if channel in channel_states:
-        state = channel_states[channel]
-        was_silenced = state.silence_mode
-        state.silence_mode = True
-        logger.info(f"Silence mode activated for channel {channel} via command")
-
-        # Send a message that the bot will be silent
-        if not was_silenced:  # Only send if we weren't already silenced
-            try:
-                await chat.send_message(channel, "I'll be quiet until I'm restarted, but I'll still create clips!")
-            except Exception as e:
-                logger.error(f"Error sending silence message to {channel}: {str(e)}")
+
+    # Only the channel owner or a moderator may silence the bot
+    if not (cmd.user.mod or cmd.user.name.lower() == channel):
+        return
+
+    await enter_silence(channel)
 
 async def main():
+    """Run the bot, releasing the shared HTTP session however it stops"""
+    try:
+        await run_bot()
+    finally:
+        # Startup can return early, after the session was opened for token checks
+        await flush_env_updates()
+        await close_session()
+
+async def run_bot():
+    """Start the bot and keep it running until a shutdown signal arrives"""
     global twitch, chat
 
     logger.info("Starting GooCrewClipBot...")
@@ -669,79 +962,67 @@ async def main():
 
     # Check token validity and expiration
     logger.info("Checking token validity...")
-    token_valid, expires_in_seconds = await check_token_validity()
+    token_valid, expires_in_seconds, needs_new_token = await check_token_validity()
+
+    # A refreshed token keeps the same client and scopes, so don't try to refresh a wrong one
+    if needs_new_token:
+        print_token_renewal_instructions()
+        return
 
     # If token is valid but expires soon (less than 3 hours), refresh it immediately
     if token_valid and expires_in_seconds is not None and expires_in_seconds < 10800:  # 10800 seconds = 3 hours
-        logger.info(f"Token expires in {expires_in_seconds} seconds (less than 3 hours), refreshing immediately...")
-        twitch_api_success = await refresh_with_twitch_api()
-
-        if not twitch_api_success:
-            logger.warning("Direct Twitch API refresh failed, trying TwitchTokenGenerator")
-            await refresh_with_twitchtokengenerator()
-
-        # Verify the token was refreshed successfully
-        token_valid, _ = await check_token_validity()
+        logger.info("Token expires in %s seconds (less than 3 hours), refreshing immediately...", expires_in_seconds)
+        # The refresh response reports the new expiry, only validate if it didn't.
+        # If the refresh failed, the current token is still valid for now.
+        if await ensure_fresh_token("startup, expiring soon") and token_expires_at is None:
+            token_valid, _, _ = await check_token_validity()
 
     # If token is not valid, try to refresh it
     if not token_valid:
-        logger.warning("Token validation failed, attempting direct refresh with Twitch API...")
-        twitch_api_success = await refresh_with_twitch_api()
-
-        # If direct refresh fails, try TwitchTokenGenerator as fallback
-        if not twitch_api_success:
-            logger.warning("Direct Twitch API refresh failed, trying TwitchTokenGenerator")
-            ttg_success = await refresh_with_twitchtokengenerator()
+        logger.warning("Token validation failed, attempting refresh...")
+        if not await ensure_fresh_token("startup, token invalid"):
+            logger.error("All token refresh methods failed.")
+            print_token_renewal_instructions()
+            return
 
-            if not ttg_success:
-                logger.error("All token refresh methods failed.")
+        # Trust the expiry from the refresh response, only validate if it didn't report one
+        if token_expires_at is None:
+            token_valid, _, _ = await check_token_validity()
+            if not token_valid:
+                logger.error("Token still invalid after refresh. Please check your credentials.")
                 print_token_renewal_instructions()
                 return
 
-        # Check validity again after refresh
-        token_valid, _ = await check_token_validity()
-        if not token_valid:
-            logger.error("Token still invalid after refresh. Please check your credentials.")
-            print_token_renewal_instructions()
-            return
-
     # Initialize Twitch API with client ID and secret
     twitch = await Twitch(APP_ID, APP_SECRET)
 
     # Define a token refresh callback
     async def token_refresh_callback(token, refresh_token):
-        global ACCESS_TOKEN, REFRESH_TOKEN, last_token_refresh
-        logger.info(f"Token refreshed by Twitch API at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-
-        # Update global variables
-        ACCESS_TOKEN = token
-        REFRESH_TOKEN = refresh_token
-        last_token_refresh = datetime.now()
-
-        # Update the .env file with the new tokens
-        update_env_file(token, refresh_token)
+        # The callback doesn't report the new expiry, validate on the next check
+        store_tokens(token, refresh_token, None)
+        logger.info("Token refreshed by Twitch API at %s", datetime.now())
 
-    # Set the token refresh callback
-    twitch.token_refresh_callback = token_refresh_callback
+    # Set the token refresh callback, twitchAPI calls this whenever it refreshes the user token itself
+    twitch.user_auth_refresh_callback = token_refresh_callback
 
     # Enable auto refresh to keep the token valid
     twitch.auto_refresh_auth = True
 
-    # Set the authentication directly with the tokens
-    await twitch.set_user_authentication(ACCESS_TOKEN, USER_SCOPE, REFRESH_TOKEN)
-
-    # Verify authentication worked
+    # Set the authentication directly with the tokens and verify it worked
     try:
+        await twitch.set_user_authentication(ACCESS_TOKEN, USER_SCOPE, REFRESH_TOKEN)
         user = await first(twitch.get_users())
         if user:
-            logger.info(f"Authenticated as: {user.display_name}")
+            logger.info("Authenticated as: %s", user.display_name)
         else:
             logger.error("Authentication failed: Could not retrieve user information")
             print_token_renewal_instructions()
+            await twitch.close()
             return
-    except Exception as e:
-        logger.error(f"Authentication failed: {str(e)}")
+    except Exception:
+        logger.exception("Authentication failed")
         print_token_renewal_instructions()
+        await twitch.close()
         return
 
     # Initialize chat connection
@@ -760,10 +1041,19 @@ async def main():
     # Start the bot
     chat.start()
 
-    # Keep the bot running
+    # Stop when the process receives Ctrl+C or SIGTERM
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Not available on Windows, Ctrl+C still raises KeyboardInterrupt there
+
+    # Keep the bot running until a shutdown signal arrives
     try:
-        while True:
-            await asyncio.sleep(1)
+        await stop_event.wait()
+        logger.info("Bot shutting down...")
     except KeyboardInterrupt:
         logger.info("Bot shutting down...")
     finally:
@@ -774,8 +1064,18 @@ async def main():
         except asyncio.CancelledError:
             pass
 
-        chat.stop()
-        await twitch.close()
+        # main() saves pending tokens and closes the HTTP session after this
+        try:
+            chat.stop()
+        finally:
+            await twitch.close()
 
 if __name__ == "__main__":
+    # Use uvloop's faster event loop where it is installed (not available on Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     asyncio.run(main())